@@ -1,8 +1,19 @@
 import streamlit as st
-import pandas as pd
-from gemini_logic import analyze_user_input
+from gemini_logic import (
+    create_client, MoodTipsStream, iter_field_text, parse_mood_tips, analyze_mood_tips, fetch_media_async,
+    init_history_db, save_mood_entry, has_mood_history, get_mood_history
+)
 import os
+import copy
+import time
+import uuid
 import random
+import asyncio
+import threading
+import collections
+import concurrent.futures
+import hashlib
+import html
 
 # to run this Project jst go to terminal and type -> strealit run app.py
 # --- Streamlit Configuration ---
@@ -13,15 +24,177 @@ st.set_page_config(
 )
 
 # Initialize Session State for history and results
-if 'history' not in st.session_state:
-    st.session_state.history = []
+# History rows live in SQLite under a diary id kept in the URL (?diary=...),
+# so the history survives reloads and can be reopened from a bookmark
+if 'diary' not in st.query_params:
+    st.query_params['diary'] = uuid.uuid4().hex
+st.session_state.diary_id = st.query_params['diary']
 
 if 'report_data' not in st.session_state:
     st.session_state.report_data = None
 
+if 'report_retries' not in st.session_state:
+    st.session_state.report_retries = 0
+
+# Map mood to a numeric score for visualization
+MOOD_SCORE_MAP = {
+    "Joyful": 5, "Happy": 4, "Calm": 3, "Neutral": 3, 
+    "Anxious": 2, "Stressed": 2, "Sad": 1, "Angry": 1, "Frustrated": 1
+}
+
+@st.cache_resource
+def _mood_scoring():
+    """
+    Vectorized form of MOOD_SCORE_MAP: category codes index straight into the score array.
+    Built on first use (and kept across reruns) so pandas/numpy are not imported before the page is drawn.
+    """
+    import numpy as np
+    import pandas as pd
+
+    categories = pd.CategoricalDtype(list(MOOD_SCORE_MAP), ordered=False)
+    scores = np.array(list(MOOD_SCORE_MAP.values()), dtype=np.int8)
+    return categories, scores
+
+# --- Cached Resources ---
+@st.cache_resource
+def get_client(api_key: str):
+    """Creates one Gemini client per API key and reuses it (and its connection pool) across reruns and sessions."""
+    return create_client(api_key)
+
+@st.cache_resource
+def get_db_path() -> str:
+    """Creates the history database once per process; each access opens its own connection."""
+    db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mood_history.db")
+    init_history_db(db_path)
+    return db_path
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Runs one background event loop for all sessions. asyncio.run would open a new loop
+    per report, while the cached client's async connection pool is bound to a single loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Upper bound for the media calls, including retries, so a stuck call can't block the script thread
+GEMINI_TIMEOUT = 90
+
+# Parsed reports are reused for identical requests (same text, counts and API key)
+REPORT_CACHE_TTL = 3600
+REPORT_CACHE_SIZE = 256
+
+@st.cache_resource
+def _report_cache():
+    """Report data shared by all sessions: an LRU of key -> (stored_at, data) and its lock."""
+    return collections.OrderedDict(), threading.Lock()
+
+def _cached_report(key: tuple):
+    """Returns a copy of the cached report data for key, or None if missing or expired."""
+    cache, lock = _report_cache()
+    with lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        stored_at, data = entry
+        if time.monotonic() - stored_at > REPORT_CACHE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return copy.deepcopy(data)
+
+def _store_report(key: tuple, data: dict) -> None:
+    """Caches a successfully parsed report, evicting the least recently used entries."""
+    cache, lock = _report_cache()
+    with lock:
+        cache[key] = (time.monotonic(), copy.deepcopy(data))
+        cache.move_to_end(key)
+        while len(cache) > REPORT_CACHE_SIZE:
+            cache.popitem(last=False)
+
+# Labels for the mood/tips fields while they stream in
+STREAM_LABELS = {
+    "overall_mood": "Mood",
+    "mood_summary": "Summary",
+    "health_tip_1": "Tip 1",
+    "health_tip_2": "Tip 2",
+}
+
+def _narrate(stream):
+    """
+    Turns the streamed JSON answer into readable markdown: a bold label per field, then its text.
+    """
+    field = None
+    for name, text in iter_field_text(stream):
+        if name not in STREAM_LABELS:
+            continue
+        if name != field:
+            if field is not None:
+                yield "\n\n"
+            yield f"**{STREAM_LABELS[name]}:** "
+            field = name
+        yield text
+
+def _run_report(client, user_text: str, num_movies: int, num_books: int):
+    """
+    Streams the mood/tips answer into the page while the movie and book calls run on the
+    background loop, then merges them. Returns (data, retries); errors are raised.
+    """
+    media_future = None
+    if num_movies or num_books:
+        media_future = asyncio.run_coroutine_threadsafe(
+            fetch_media_async(
+                user_text=user_text, 
+                num_movies=num_movies, 
+                num_books=num_books,
+                client=client
+            ),
+            get_event_loop()
+        )
+
+    live_output = st.empty()
+    try:
+        # Stream the mood/tips so the first tokens show up as soon as Gemini sends them
+        stream = MoodTipsStream(user_text, client)
+        with live_output.container():
+            st.caption("🧠 Analyzing your mood and generating personalized advice...")
+            st.write_stream(_narrate(stream))
+        try:
+            data, retries = parse_mood_tips(stream.text), stream.retries
+        except ValueError:
+            # Cut off or off-schema: drop the partial text, then one blocking call
+            # (it widens the budget if truncated)
+            live_output.empty()
+            with st.spinner("🧠 Analyzing your mood and generating personalized advice..."):
+                data, retries = analyze_mood_tips(user_text, client)
+
+        media = {"movie_recommendations": [], "book_recommendations": [], "retries": 0}
+        if media_future is not None:
+            try:
+                media = media_future.result(timeout=GEMINI_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                raise RuntimeError(f"Gemini did not answer within {GEMINI_TIMEOUT} seconds. Please try again.")
+    finally:
+        # No-op once the media calls finished; otherwise stops them and their retries
+        if media_future is not None:
+            media_future.cancel()
+        live_output.empty()
+
+    data["movie_recommendations"] = media["movie_recommendations"]
+    data["book_recommendations"] = media["book_recommendations"]
+    return data, retries + media["retries"]
+
+def _fingerprint(api_key: str) -> str:
+    """Hashes the API key so the secret itself never ends up in a cache key."""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
 # --- Main Logic Function (Called by the button) ---
-def generate_report():
-    """Handles the full process from user input to API call."""
+def generate_report(fresh: bool = False):
+    """
+    Handles the full process from user input to API call.
+    With fresh=True the cached report is skipped (and replaced) for this request only.
+    """
     
     user_text = st.session_state.user_text
     
@@ -38,37 +211,53 @@ def generate_report():
         st.session_state.report_data = None
         return
 
-    # Check for recommendation toggles and sliders
-    num_movies = st.session_state.movie_toggle * st.session_state.num_movies_slider
-    num_books = st.session_state.book_toggle * st.session_state.num_books_slider
-
-    with st.spinner("🧠 Analyzing your mood and generating personalized advice..."):
-        # Call the external logic function
-        result = analyze_user_input(
-            user_text=user_text, 
-            num_movies=num_movies, 
-            num_books=num_books,
-            api_key=gemini_key  # <--- PASS THE KEY HERE
-        )
-
-    if result.get("error"):
-        st.error(result["error"])
+    try:
+        client = get_client(gemini_key)
+    except Exception as e:
+        st.error(f"API Client Error. Ensure GEMINI_API_KEY is set. Details: {e}")
         st.session_state.report_data = None
-    else:
-        # Store the successful report data
-        data = result["data"]
-        st.session_state.report_data = data
-        
-        # Add to history for the future (simple in-memory storage)
-        st.session_state.history.append({
-            "timestamp": pd.Timestamp.now(),
-            "mood": data["overall_mood"],
-            "summary": data["mood_summary"],
-            "movies": len(data["movie_recommendations"]),
-            "books": len(data["book_recommendations"]),
-        })
+        return
+
+    # Derive the counts from the toggles; a slider only exists while its toggle is on
+    num_movies = st.session_state.num_movies_slider if st.session_state.movie_toggle else 0
+    num_books = st.session_state.num_books_slider if st.session_state.book_toggle else 0
+
+    # Identical requests are answered from the cache; the key fingerprint keeps the secret out of it
+    cache_key = (user_text, num_movies, num_books, _fingerprint(gemini_key))
+    data = None if fresh else _cached_report(cache_key)
+    retries = 0
+
+    if data is None:
+        try:
+            data, retries = _run_report(client, user_text, num_movies, num_books)
+        except Exception as e:
+            st.error(f"Gemini API Call Failed. Details: {e}")
+            st.session_state.report_data = None
+            return
+        _store_report(cache_key, data)
+
+    # Store the successful report data
+    st.session_state.report_data = data
+    st.session_state.report_retries = retries
+
+    # Add to history for the future (SQLite, see get_db_path)
+    save_mood_entry(get_db_path(), st.session_state.diary_id, data)
+    st.session_state.has_history = True
+    st.session_state.history_df = None
+
+def _format_recommendations(recommendations) -> str:
+    """
+    Joins all recommendations into one markdown block so each list is a single element.
+    Model text is HTML-escaped because the block is rendered with unsafe_allow_html.
+    """
+    return "\n\n".join(
+        f"**{html.escape(rec['title'])}**  \n<small>{html.escape(rec['reason'])}</small>"
+        for rec in recommendations
+    )
 
 # --- UI Component: Display Report ---
+# Fragments rerun on their own, so widget changes elsewhere don't redraw the report or chart
+@st.fragment
 def display_report(data):
     """Formats and displays the structured data from the Gemini API."""
     
@@ -88,8 +277,7 @@ def display_report(data):
 
     # 2. Health & Wellness Tips
     st.markdown("### 🌿 Healthy Living Tips", unsafe_allow_html=True)
-    st.success(f"1. {data['health_tip_1']}")
-    st.success(f"2. {data['health_tip_2']}")
+    st.success(f"1. {data['health_tip_1']}\n\n2. {data['health_tip_2']}")
     
     # 3. Media Recommendations (Dynamic section)
     if data["movie_recommendations"] or data["book_recommendations"]:
@@ -101,40 +289,78 @@ def display_report(data):
         # Movies
         if data["movie_recommendations"]:
             with col_movies.expander(f"Movies ({len(data['movie_recommendations'])})"):
-                for rec in data["movie_recommendations"]:
-                    st.write(f"**{rec['title']}**")
-                    st.caption(rec['reason'])
+                st.markdown(_format_recommendations(data["movie_recommendations"]), unsafe_allow_html=True)
         
         # Books
         if data["book_recommendations"]:
             with col_books.expander(f"Books ({len(data['book_recommendations'])})"):
-                for rec in data["book_recommendations"]:
-                    st.write(f"**{rec['title']}**")
-                    st.caption(rec['reason'])
+                st.markdown(_format_recommendations(data["book_recommendations"]), unsafe_allow_html=True)
     
+def _load_history_df():
+    """Reads the latest entries of the diary and scores them for the trend chart."""
+    import numpy as np
+
+    # Only the latest entries are read, so the chart stays O(limit)
+    df_history = get_mood_history(
+        get_db_path(), st.session_state.diary_id, limit=100,
+        # The browser's time zone when Streamlit reports it, else the server's
+        tz=getattr(st.context, "timezone", None)
+    )
+
+    mood_categories, mood_scores = _mood_scoring()
+    codes = df_history['mood'].astype(mood_categories).cat.codes.to_numpy()
+    # Unknown labels get code -1; leave them unscored instead of indexing the last score
+    df_history['score'] = np.where(codes >= 0, mood_scores[codes], np.nan)
+    return df_history
+
 # --- UI Component: History and Trend (Resume Feature) ---
+@st.fragment
 def display_history():
-    """Displays a mood trend chart using mock scoring."""
+    """Displays a mood trend chart using mock scoring. Call it inside `with st.sidebar:`."""
     
-    if not st.session_state.history:
-        st.sidebar.info("Submit your first entry to see your mood history!")
+    # Whether the diary has any rows: checked once per diary, then set by generate_report.
+    # A new diary thus skips the query (and the pandas import) entirely.
+    if st.session_state.get('history_checked_for') != st.session_state.diary_id:
+        st.session_state.history_checked_for = st.session_state.diary_id
+        st.session_state.has_history = has_mood_history(get_db_path(), st.session_state.diary_id)
+        st.session_state.history_df = None
+
+    if not st.session_state.has_history:
+        st.info("Submit your first entry to see your mood history!")
+        return
+
+    # The scored frame is reused across reruns until generate_report adds an entry
+    if st.session_state.get('history_df') is None:
+        st.session_state.history_df = _load_history_df()
+    df_history = st.session_state.history_df
+
+    if df_history.empty:
+        st.info("Submit your first entry to see your mood history!")
         return
-        
-    # Map mood to a numeric score for visualization
-    mood_score_map = {
-        "Joyful": 5, "Happy": 4, "Calm": 3, "Neutral": 3, 
-        "Anxious": 2, "Stressed": 2, "Sad": 1, "Angry": 1, "Frustrated": 1
-    }
 
-    # Create a DataFrame from history for charting
-    df_history = pd.DataFrame(st.session_state.history)
-    df_history['score'] = df_history['mood'].map(mood_score_map)
-    df_history['day'] = df_history['timestamp'].dt.strftime('%m-%d %H:%M')
+    st.markdown("---")
+    st.markdown("### 📈 Mood Trend")
+    st.line_chart(df_history, x='timestamp', y='score', color='#88b495')
+    st.caption("Higher score = More positive mood.")
+    st.caption("🔖 Bookmark this page to come back to your history.")
+
+# --- UI Component: Media Settings ---
+@st.fragment
+def media_settings():
+    """Toggles and sliders for recommendations; changing them only reruns this fragment."""
+    col1, col2 = st.columns(2)
+
+    # Movie Selection
+    with col1:
+        st.toggle("🎬 Want Movie Recommendations?", key="movie_toggle")
+        if st.session_state.movie_toggle:
+            st.slider("How many movies?", 1, 5, 2, key="num_movies_slider", help="Select 1 to 5 movies.")
 
-    st.sidebar.markdown("---")
-    st.sidebar.markdown("### 📈 Mood Trend")
-    st.sidebar.line_chart(df_history, x='day', y='score', color='#88b495')
-    st.sidebar.caption("Higher score = More positive mood.")
+    # Book Selection
+    with col2:
+        st.toggle("📚 Want Book Recommendations?", key="book_toggle")
+        if st.session_state.book_toggle:
+            st.slider("How many books?", 1, 5, 2, key="num_books_slider", help="Select 1 to 5 books.")
 
 
 # --- Application Layout ---
@@ -153,23 +379,7 @@ st.markdown("---")
 
 # 2. Recommendation Settings (Interactive Widgets)
 st.subheader("🎬 Media Settings")
-col1, col2 = st.columns(2)
-
-# Movie Selection
-with col1:
-    st.toggle("🎬 Want Movie Recommendations?", key="movie_toggle")
-    if st.session_state.movie_toggle:
-        st.slider("How many movies?", 1, 5, 2, key="num_movies_slider", help="Select 1 to 5 movies.")
-    else:
-        st.session_state.num_movies_slider = 0
-
-# Book Selection
-with col2:
-    st.toggle("📚 Want Book Recommendations?", key="book_toggle")
-    if st.session_state.book_toggle:
-        st.slider("How many books?", 1, 5, 2, key="num_books_slider", help="Select 1 to 5 books.")
-    else:
-        st.session_state.num_books_slider = 0
+media_settings()
 
 # 3. Generate Button
 st.markdown("---")
@@ -180,12 +390,25 @@ st.button(
     type="primary"
 )
 
+if st.session_state.report_data:
+    st.button(
+        "🔄 Regenerate", 
+        on_click=generate_report,
+        kwargs={"fresh": True},
+        use_container_width=True,
+        help="Ignore the cached answer and ask Gemini again."
+    )
+
 # 4. Report Output Area
 if st.session_state.report_data:
     st.markdown("---")
     display_report(st.session_state.report_data)
+    if st.session_state.report_retries:
+        st.caption(f"⏳ Gemini was busy, retried {st.session_state.report_retries}x.")
 
 # 5. History Sidebar (Resume Feature)
+# Fragments can't write to st.sidebar from inside, so the fragment is placed in it
+with st.sidebar:
+    display_history()
 
-display_history()
 
@@ -1,102 +1,470 @@
 import os
 import json
-from google import genai
+import time
+import random
+import asyncio
+import logging
+import functools
+import sqlite3
+import datetime
+import contextlib
 from pydantic import BaseModel, Field
-from typing import List, Literal, Optional, Dict, Any
+from typing import TYPE_CHECKING, List, Literal, Optional, Dict, Any, Iterable, Iterator, Tuple, get_args
+
+# google.genai (grpc, protobuf, auth), httpx and pandas are heavy to import, so they are
+# imported inside the functions that use them and only load once a report is requested.
+if TYPE_CHECKING:
+    import pandas as pd
+    from google import genai
+    from google.genai import errors
+
+# orjson parses noticeably faster; the stdlib parser is the fallback
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
 
 # --- Pydantic Schema ---
 
 
 # Define a restricted set of mood labels
 Mood = Literal["Joyful", "Happy", "Calm", "Neutral", "Anxious", "Stressed", "Sad", "Angry", "Frustrated"]
+MOOD_LABELS = frozenset(get_args(Mood))
 
 class Recommendation(BaseModel):
     """A sub-model for a single book or movie recommendation."""
     title: str = Field(description="The title of the movie or book.")
     reason: str = Field(description="A brief, one-sentence reason for the recommendation.")
 
-class UserAnalysis(BaseModel):
-    """The main structured model for all analysis and recommendations."""
+class MoodTips(BaseModel):
+    """The mood analysis and wellness tips, streamed while the media calls run in parallel."""
     overall_mood: Mood = Field(description="The primary emotional state derived from the user's text.")
     mood_summary: str = Field(description="A brief explanation of why the text suggests this mood.")
     health_tip_1: str = Field(description="A practical, first tip for staying healthy based on the mood.")
     health_tip_2: str = Field(description="A second, complementary tip for mental or physical wellness.")
-    movie_recommendations: List[Recommendation] = Field(
-        default=[], 
-        description="A list of movie recommendations, or an empty list if none were requested."
-    )
-    book_recommendations: List[Recommendation] = Field(
-        default=[], 
-        description="A list of book recommendations, or an empty list if none were requested."
+
+class MovieList(BaseModel):
+    """Movie recommendations requested in their own call."""
+    movies: List[Recommendation] = Field(description="The requested movie recommendations.")
+
+class BookList(BaseModel):
+    """Book recommendations requested in their own call."""
+    books: List[Recommendation] = Field(description="The requested book recommendations.")
+
+# --- Client ---
+
+def create_client(api_key: str) -> "genai.Client":
+    """
+    Builds a Gemini client on our own HTTP/2 keep-alive httpx clients, so warm calls skip the
+    TCP/TLS handshake. Passing the clients explicitly keeps the SDK on httpx even when aiohttp
+    is installed. The caller is expected to cache it. To check connection reuse, set the
+    "httpcore" logger to DEBUG: a reused call logs no new "connect_tcp" / "start_tls".
+    """
+    import httpx
+    from google import genai
+    from google.genai import types
+
+    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            httpx_client=httpx.Client(http2=True, limits=limits),
+            httpx_async_client=httpx.AsyncClient(http2=True, limits=limits),
+        ),
     )
 
 # --- Core Logic Function ---
 
-def analyze_user_input(
+# Output token budgets. Thinking is disabled below, so the budget only covers the JSON answer.
+MOOD_TIPS_TOKENS = 384
+TOKENS_PER_RECOMMENDATION = 96
+
+# NOTE: System instructions are fixed strings (one per call type, no f-strings) and everything
+# that varies per request (counts, user text) goes at the end of the user prompt. Gemini's implicit
+# prefix caching only applies to prefixes of 1024+ tokens, which these short instructions
+# don't reach, so this buys nothing today; it keeps them eligible if they ever grow.
+MOOD_TIPS_INSTRUCTION = (
+    "You are an empathetic wellness assistant. Identify the user's mood and give "
+    "two wellness tips for it. Reply with JSON matching the schema."
+)
+
+MEDIA_INSTRUCTION = (
+    "You are an empathetic wellness assistant. Suggest exactly the requested number of "
+    "movies or books that suit the user's mood. Reply with JSON matching the schema."
+)
+
+@functools.lru_cache(maxsize=64)
+def _request_details(num_movies: int, num_books: int) -> str:
+    """
+    Builds the "Requested: ..." line. There are only ~36 (movies, books) pairs, so it is cached.
+    """
+    return f"Requested: {num_movies} movies, {num_books} books.\n"
+
+def _user_prompt(user_text: str, num_movies: int, num_books: int) -> str:
+    """
+    Builds the user turn: the small, varying request details first, the user's text last.
+    """
+    return f"{_request_details(num_movies, num_books)}User text: '{user_text}'"
+
+def _generation_config(system_instruction: str, schema, max_output_tokens: int) -> Dict[str, Any]:
+    """
+    Builds the structured-output config shared by every Gemini call.
+    """
+    return {
+        "system_instruction": system_instruction,
+        "response_mime_type": "application/json",
+        "response_schema": schema,
+        "max_output_tokens": max_output_tokens,
+        "thinking_config": {"thinking_budget": 0},
+    }
+
+# --- Retry Handling ---
+
+MAX_ATTEMPTS = 5
+
+def _is_retryable(error: "errors.APIError") -> bool:
+    """Rate limits (429) and server-side failures (5xx) are worth retrying; auth or bad requests are not."""
+    return error.code == 429 or (error.code or 0) >= 500
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, capped at 30 seconds."""
+    return min(2 ** attempt + random.random(), 30)
+
+def _generate_with_retry(client: "genai.Client", prompt: str, config: Dict[str, Any]):
+    """
+    Runs a blocking Gemini call, retrying transient errors. Returns (response, retries).
+    """
+    from google.genai import errors
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = client.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config=config,
+            )
+            return response, attempt
+        except errors.APIError as e:
+            if not _is_retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            logger.warning("Gemini call failed with %s, retry %d of %d", e.code, attempt + 1, MAX_ATTEMPTS - 1)
+            time.sleep(_backoff_delay(attempt))
+
+async def _generate_with_retry_async(client: "genai.Client", prompt: str, config: Dict[str, Any]):
+    """
+    Async counterpart of _generate_with_retry. Returns (response, retries).
+    """
+    from google.genai import errors
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = await client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config=config,
+            )
+            return response, attempt
+        except errors.APIError as e:
+            if not _is_retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            logger.warning("Gemini call failed with %s, retry %d of %d", e.code, attempt + 1, MAX_ATTEMPTS - 1)
+            await asyncio.sleep(_backoff_delay(attempt))
+
+def _is_truncated(response) -> bool:
+    """True when the answer was cut off by max_output_tokens, which leaves the JSON incomplete."""
+    from google.genai import types
+
+    candidates = response.candidates or []
+    return bool(candidates) and candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
+
+def _widened(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Same config with twice the output budget, for the one retry after a truncated answer."""
+    logger.warning("Gemini answer hit max_output_tokens=%d, retrying with double", config["max_output_tokens"])
+    return {**config, "max_output_tokens": config["max_output_tokens"] * 2}
+
+def _response_dict(response) -> Dict[str, Any]:
+    """
+    Returns the answer the SDK already parsed and validated against the schema.
+    Raises ValueError when it could not be parsed (e.g. cut off or off-schema).
+    """
+    if response.parsed is None:
+        raise ValueError("Gemini returned an answer that does not match the schema.")
+    return response.parsed.model_dump()
+
+def _checked_dict(data: Any, schema) -> Dict[str, Any]:
+    """
+    Checks JSON loaded from a streamed answer, which the SDK does not parse. Full validation
+    only runs if the keys drift or the mood is not one of the Mood labels (the chart can only
+    score those).
+    """
+    if (
+        not isinstance(data, dict)
+        or data.keys() != schema.model_fields.keys()
+        or data.get("overall_mood", "Neutral") not in MOOD_LABELS
+    ):
+        data = schema.model_validate(data).model_dump()
+    return data
+
+def _generate(client: "genai.Client", prompt: str, config: Dict[str, Any]):
+    """
+    Blocking call with retries; a truncated answer is retried once with a larger budget.
+    Returns (response, retries).
+    """
+    response, retries = _generate_with_retry(client, prompt, config)
+    if _is_truncated(response):
+        response, more_retries = _generate_with_retry(client, prompt, _widened(config))
+        retries += more_retries + 1
+    return response, retries
+
+# --- Split Logic: Streamed Mood/Tips + Parallel Media ---
+
+def _mood_tips_request(user_text: str):
+    """
+    Builds the prompt and generation config for the mood/tips call.
+    """
+    prompt = f"User text: '{user_text}'"
+    return prompt, _generation_config(MOOD_TIPS_INSTRUCTION, MoodTips, MOOD_TIPS_TOKENS)
+
+class MoodTipsStream:
+    """
+    Streams the mood/tips answer as raw JSON text chunks (see iter_field_text to show them).
+    Transient errors are retried until the first chunk has arrived. Once iterated,
+    `text` holds the full answer and `retries` how many retries it took.
+    """
+
+    def __init__(self, user_text: str, client: "genai.Client"):
+        self.client = client
+        self.prompt, self.config = _mood_tips_request(user_text)
+        self.text = ""
+        self.retries = 0
+
+    def __iter__(self) -> Iterator[str]:
+        from google.genai import errors
+
+        for attempt in range(MAX_ATTEMPTS):
+            chunks = []
+            try:
+                for chunk in self.client.models.generate_content_stream(
+                    model="gemini-2.5-flash",
+                    contents=self.prompt,
+                    config=self.config,
+                ):
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield chunk.text
+                self.text = "".join(chunks)
+                self.retries = attempt
+                return
+            except errors.APIError as e:
+                # Once text has been shown a retry would repeat it, so only retry before that
+                if chunks or not _is_retryable(e) or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                logger.warning("Gemini stream failed with %s, retry %d of %d", e.code, attempt + 1, MAX_ATTEMPTS - 1)
+                time.sleep(_backoff_delay(attempt))
+
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+def iter_field_text(chunks: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Decodes the top-level string fields of a streamed JSON object as the chunks arrive and
+    yields (field, text) pieces, so a partial answer can be shown without its JSON syntax.
+    Nested values (lists, objects) are skipped. Decoding is best effort; parse the full text.
+    """
+    depth = 0
+    expect_key = False
+    in_string = False
+    is_value = False
+    key = ""
+    text = []
+    escape = None  # None outside an escape, else what followed the backslash so far
+    high = None  # pending high surrogate of a \uXXXX pair
+    for chunk in chunks:
+        for ch in chunk:
+            if not in_string:
+                if ch == '"':
+                    in_string, is_value, text = True, depth == 1 and not expect_key, []
+                elif ch in "{[":
+                    depth += 1
+                    expect_key = depth == 1
+                elif ch in "}]":
+                    depth -= 1
+                elif depth == 1 and ch in ",:":
+                    expect_key = ch == ","
+                continue
+
+            if escape is not None:
+                escape += ch
+                if escape[0] != "u":
+                    decoded, escape = _JSON_ESCAPES.get(ch, ch), None
+                elif len(escape) < 5:
+                    continue
+                else:
+                    try:
+                        code = int(escape[1:], 16)
+                    except ValueError:
+                        code = 0xFFFD
+                    escape = None
+                    if 0xD800 <= code < 0xDC00:
+                        high = code
+                        continue
+                    if 0xDC00 <= code < 0xE000:
+                        code = 0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00) if high else 0xFFFD
+                    decoded = chr(code)
+                high = None
+            elif ch == "\\":
+                escape = ""
+                continue
+            elif ch == '"':
+                in_string = False
+                high = None
+                if is_value:
+                    if text:
+                        yield key, "".join(text)
+                elif depth == 1 and expect_key:
+                    key = "".join(text)
+                text = []
+                continue
+            else:
+                decoded, high = ch, None
+            text.append(decoded)
+
+        # Hand over what this chunk added to the current value; keys wait until they're complete
+        if in_string and is_value and text:
+            yield key, "".join(text)
+            text = []
+
+def parse_mood_tips(raw_text: str) -> Dict[str, Any]:
+    """
+    Parses a streamed mood/tips answer. Raises ValueError when it is cut off or off-schema.
+    """
+    return _checked_dict(_json_loads(raw_text), MoodTips)
+
+def analyze_mood_tips(user_text: str, client: "genai.Client") -> Tuple[Dict[str, Any], int]:
+    """
+    Blocking mood/tips call, the fallback when a streamed answer could not be parsed.
+    Returns (answer, retries); errors are raised.
+    """
+    prompt, config = _mood_tips_request(user_text)
+    response, retries = _generate(client, prompt, config)
+    return _response_dict(response), retries
+
+async def _generate_async(client: "genai.Client", prompt: str, config: Dict[str, Any]):
+    """
+    Runs one structured Gemini call on the async client. Returns (answer dict, retries).
+    """
+    response, retries = await _generate_with_retry_async(client, prompt, config)
+    if _is_truncated(response):
+        response, more_retries = await _generate_with_retry_async(client, prompt, _widened(config))
+        retries += more_retries + 1
+    return _response_dict(response), retries
+
+async def fetch_media_async(
     user_text: str, 
     num_movies: int = 0, 
     num_books: int = 0,
-    api_key: str = None
+    client: "genai.Client" = None
 ) -> Dict[str, Any]:
     """
-    Analyzes user text using the Gemini API and returns a structured dictionary.
+    Fetches movie and book recommendations as concurrent calls; a count of 0 skips that call.
+    Returns the movie_recommendations and book_recommendations lists plus "retries". If one call fails the
+    other is cancelled and the error is raised.
     """
-    
-    # 1. Initialize Client
-    try:
-        # Pass the key directly to the client constructor
-        client = genai.Client(api_key=api_key)  # <--- USE THE api_key HERE
-    except Exception as e:
-        return {"error": f"API Client Error. Ensure GEMINI_API_KEY is set. Details: {e}"}
-
-    # 2. Dynamically Build Instructions
-    recommendation_instructions = ""
-    
+    media = {"movie_recommendations": [], "book_recommendations": [], "retries": 0}
+
+    # Report field -> (running call, key of that list in its answer)
+    calls = {}
     if num_movies > 0:
-        recommendation_instructions += f"and suggest exactly {num_movies} relevant movies,"
-    
+        calls["movie_recommendations"] = (asyncio.ensure_future(_generate_async(
+            client, _user_prompt(user_text, num_movies, 0),
+            _generation_config(MEDIA_INSTRUCTION, MovieList, TOKENS_PER_RECOMMENDATION * num_movies)
+        )), "movies")
     if num_books > 0:
-        recommendation_instructions += f"and suggest exactly {num_books} relevant books,"
-        
-    recommendation_instructions = recommendation_instructions.rstrip(', ')
-    
-    # 3. Define System Instruction and Prompt
-    system_instruction = (
-        "You are an empathetic wellness assistant. Your task is to analyze the user's "
-        "text, determine their mood, provide two helpful health and wellness tips tailored "
-        "to that mood"
-        f" {recommendation_instructions}. "
-        "You must return the entire response in a single JSON object that strictly adheres "
-        "to the provided schema. If a recommendation type was not requested (count is 0), "
-        "return an empty list for that field."
-    )
-    
-    prompt = f"Analyze my current situation and provide advice based on this: '{user_text}'"
+        calls["book_recommendations"] = (asyncio.ensure_future(_generate_async(
+            client, _user_prompt(user_text, 0, num_books),
+            _generation_config(MEDIA_INSTRUCTION, BookList, TOKENS_PER_RECOMMENDATION * num_books)
+        )), "books")
 
-    # 4. Generate Content
+    tasks = [task for task, _ in calls.values()]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the sibling call (and its retries) as soon as one of them fails
+        for task in tasks:
+            task.cancel()
+        raise
+
+    for (field, (_, key)), (answer, retries) in zip(calls.items(), results):
+        media[field] = answer[key]
+        media["retries"] += retries
+    return media
+
+# --- History Management (SQLite) ---
+
+@contextlib.contextmanager
+def _history_connection(db_path: str):
+    """
+    Opens a short-lived connection, so every Streamlit script thread uses its own
+    instead of sharing one. Commits on success, rolls back on error.
+    """
+    conn = sqlite3.connect(db_path)
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config={
-                "system_instruction": system_instruction,
-                "response_mime_type": "application/json",
-                "response_schema": UserAnalysis,
-            },
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def init_history_db(db_path: str) -> None:
+    """Creates the moods table (and its index) if it does not exist yet."""
+    with _history_connection(db_path) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS moods ("
+            "diary_id TEXT NOT NULL, ts INTEGER NOT NULL, mood TEXT NOT NULL, "
+            "n_movies INTEGER, n_books INTEGER)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS moods_diary_ts ON moods(diary_id, ts)")
+
+def save_mood_entry(db_path: str, diary_id: str, data: Dict[str, Any]) -> None:
+    """Stores one generated report in the history table."""
+    with _history_connection(db_path) as conn:
+        conn.execute(
+            "INSERT INTO moods(diary_id, ts, mood, n_movies, n_books) VALUES (?, ?, ?, ?, ?)",
+            (
+                diary_id,
+                time.time_ns(),
+                data["overall_mood"],
+                len(data["movie_recommendations"]),
+                len(data["book_recommendations"]),
+            ),
         )
-        
-        # The SDK automatically parses the JSON into the Pydantic object
-        # We convert it to a dict for easy use in Streamlit's session_state
-        return {"success": True, "data": response.parsed.model_dump()}
-
-    except Exception as e:
-        return {"error": f"Gemini API Call Failed. Details: {e}"}
-
-# --- Optional History Management (Stub) ---
-# NOTE: In a full project, this would use SQLite or similar. 
-# For Streamlit prototyping, session_state is used in app.py
-def get_mood_history():
-    """Placeholder for fetching a user's past entries."""
-    # In a real app, this would query a database
-
-    return []
+
+def has_mood_history(db_path: str, diary_id: str) -> bool:
+    """Cheap existence check (no pandas) so an empty diary never loads the charting stack."""
+    with _history_connection(db_path) as conn:
+        row = conn.execute("SELECT 1 FROM moods WHERE diary_id = ? LIMIT 1", (diary_id,)).fetchone()
+    return row is not None
+
+def get_mood_history(db_path: str, diary_id: str, limit: int = 100, tz: Optional[str] = None) -> "pd.DataFrame":
+    """
+    Returns the latest `limit` entries of a diary, oldest first, ready for charting.
+    Timestamps are naive wall-clock times in `tz` (the server's local zone if None).
+    """
+    import pandas as pd
+
+    with _history_connection(db_path) as conn:
+        df_history = pd.read_sql_query(
+            "SELECT ts AS timestamp, mood FROM moods WHERE diary_id = ? ORDER BY ts DESC LIMIT ?",
+            conn,
+            params=(diary_id, limit),
+        )
+    # ts is stored as epoch nanoseconds (UTC), converted in one vectorized call
+    df_history = df_history.iloc[::-1].reset_index(drop=True)
+    df_history["timestamp"] = (
+        pd.to_datetime(df_history["timestamp"], unit="ns")
+        .dt.tz_localize("UTC")
+        .dt.tz_convert(tz or datetime.datetime.now().astimezone().tzinfo)
+        .dt.tz_localize(None)
+    )
+    return df_history